@@ -1,24 +1,52 @@
 from __future__ import annotations
 
+import asyncio
 import datetime as dt
 import hashlib
 import hmac
+import os
 import secrets
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Optional, TypeVar
 
-from fastapi import Depends, FastAPI, Header, HTTPException, Query, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / "triptales.db"
 
+T = TypeVar("T")
+
+
+def env_number(name: str, default: T, minimum: T) -> T:
+    try:
+        value = type(default)(os.environ.get(name, default))
+    except ValueError:
+        value = default
+    return max(minimum, value)
+
+
+DB_WORKERS = env_number("TRIPTALES_DB_WORKERS", 8, 1)
+DB_QUEUE_LIMIT = env_number("TRIPTALES_DB_QUEUE_LIMIT", 32, 0)
+REQUEST_TIMEOUT = env_number("TRIPTALES_REQUEST_TIMEOUT", 10.0, 0.1)
+DB_PROGRESS_STEPS = 1000
+
+db_executor: Optional[ThreadPoolExecutor] = None
+_db_inflight = 0
+_db_inflight_lock = threading.Lock()
+_db_job_local = threading.local()
+_request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
 app = FastAPI(title="TripTales API", version="1.0.0")
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "TripTales API is running"}
     
 app.add_middleware(
@@ -30,12 +58,127 @@ app.add_middleware(
 )
 
 
-def db_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+@app.middleware("http")
+async def request_deadline(request: Request, call_next):
+    token = _request_deadline.set(time.monotonic() + REQUEST_TIMEOUT)
+    try:
+        return await call_next(request)
+    finally:
+        _request_deadline.reset(token)
+
+
+def db_conn(timeout: float = 5.0) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=timeout)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=503, detail="Request deadline exceeded")
+
+
+class _DbJob:
+    """Commit/abandon race: exactly one of the worker and the request side wins,
+    so a 503 is only returned for a job that will roll back."""
+
+    def __init__(self, deadline: float) -> None:
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._state = "running"
+
+    def claim_commit(self) -> bool:
+        with self._lock:
+            if self._state == "running" and time.monotonic() < self.deadline:
+                self._state = "committing"
+            else:
+                self._state = "abandoned"
+            return self._state == "committing"
+
+    def abandon(self) -> bool:
+        with self._lock:
+            if self._state == "committing":
+                return False
+            self._state = "abandoned"
+            return True
+
+
+def check_deadline() -> None:
+    """Raise a 503 if the current DB job's deadline has passed."""
+    if time.monotonic() >= _db_job_local.job.deadline:
+        raise deadline_exceeded()
+
+
+def _release_db_slot(_: Future) -> None:
+    global _db_inflight
+    with _db_inflight_lock:
+        _db_inflight -= 1
+
+
+def _run_with_deadline(fn: Callable[..., T], job: _DbJob, args: tuple) -> T:
+    remaining = job.deadline - time.monotonic()
+    if remaining <= 0:
+        raise deadline_exceeded()
+    conn = db_conn(timeout=remaining)
+    conn.set_progress_handler(lambda: time.monotonic() >= job.deadline, DB_PROGRESS_STEPS)
+    _db_job_local.job = job
+    try:
+        result = fn(conn, *args)
+        if conn.in_transaction:
+            if not job.claim_commit():
+                conn.rollback()
+                raise deadline_exceeded()
+            conn.set_progress_handler(None, 0)
+            conn.commit()
+        return result
+    except sqlite3.OperationalError:
+        if time.monotonic() >= job.deadline:
+            raise deadline_exceeded() from None
+        raise
+    finally:
+        _db_job_local.job = None
+        conn.close()
+
+
+async def run_db(fn: Callable[..., T], *args: Any) -> T:
+    """Run ``fn(conn, *args)`` on the DB executor; ``fn`` must not commit itself."""
+    global _db_inflight
+    deadline = _request_deadline.get()
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise deadline_exceeded()
+
+    with _db_inflight_lock:
+        if _db_inflight >= DB_WORKERS + DB_QUEUE_LIMIT:
+            raise HTTPException(status_code=503, detail="Server busy, try again shortly", headers={"Retry-After": "1"})
+        _db_inflight += 1
+    job = _DbJob(deadline)
+    try:
+        if db_executor is None:
+            raise RuntimeError("DB executor is not running")
+        future = db_executor.submit(_run_with_deadline, fn, job, args)
+    except RuntimeError:
+        with _db_inflight_lock:
+            _db_inflight -= 1
+        raise HTTPException(status_code=503, detail="Server is not accepting requests") from None
+    future.add_done_callback(_release_db_slot)
+    waiter = asyncio.wrap_future(future)
+
+    try:
+        done, _ = await asyncio.wait({waiter}, timeout=remaining)
+    except asyncio.CancelledError:
+        job.abandon()
+        waiter.cancel()
+        raise
+    if done:
+        return waiter.result()
+    if job.abandon():
+        waiter.cancel()
+        raise deadline_exceeded()
+    return await waiter
+
+
 def now_iso() -> str:
     return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
@@ -291,7 +434,17 @@ def init_db() -> None:
 
 @app.on_event("startup")
 def on_startup() -> None:
+    global db_executor
     init_db()
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="triptales-db")
+
+
+@app.on_event("shutdown")
+def on_shutdown() -> None:
+    global db_executor
+    executor, db_executor = db_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 class RegisterIn(BaseModel):
@@ -328,9 +481,7 @@ def parse_bearer(auth: Optional[str]) -> str:
     return auth[len(prefix) :]
 
 
-def get_current_user(authorization: Optional[str] = Header(default=None)) -> sqlite3.Row:
-    token = parse_bearer(authorization)
-    conn = db_conn()
+def _user_for_token(conn: sqlite3.Connection, token: str) -> Optional[sqlite3.Row]:
     cur = conn.cursor()
     cur.execute(
         """
@@ -340,86 +491,77 @@ def get_current_user(authorization: Optional[str] = Header(default=None)) -> sql
         """,
         (token,),
     )
-    user = cur.fetchone()
-    conn.close()
+    return cur.fetchone()
+
+
+async def get_current_user(authorization: Optional[str] = Header(default=None)) -> sqlite3.Row:
+    token = parse_bearer(authorization)
+    user = await run_db(_user_for_token, token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return user
 
 
-def get_optional_user(authorization: Optional[str] = Header(default=None)) -> Optional[sqlite3.Row]:
+async def get_optional_user(authorization: Optional[str] = Header(default=None)) -> Optional[sqlite3.Row]:
     if not authorization:
         return None
     token = parse_bearer(authorization)
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT u.* FROM users u
-        JOIN sessions s ON s.user_id = u.id
-        WHERE s.token = ?
-        """,
-        (token,),
-    )
-    user = cur.fetchone()
-    conn.close()
+    user = await run_db(_user_for_token, token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return user
 
 
-def require_admin(user: sqlite3.Row = Depends(get_current_user)) -> sqlite3.Row:
+async def require_admin(user: sqlite3.Row = Depends(get_current_user)) -> sqlite3.Row:
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Admin only")
     return user
 
 
 @app.get("/api/health")
-def health() -> dict:
+async def health() -> dict:
     return {"ok": True}
 
 
-@app.post("/api/auth/register", status_code=status.HTTP_201_CREATED)
-def register(payload: RegisterIn):
-    conn = db_conn()
+def _register(conn: sqlite3.Connection, payload: RegisterIn) -> dict:
     cur = conn.cursor()
     cur.execute("SELECT id FROM users WHERE email = ?", (payload.email.lower(),))
     if cur.fetchone():
-        conn.close()
         raise HTTPException(status_code=409, detail="Email already registered")
 
+    password_hash = hash_password(payload.password)
+    check_deadline()
     cur.execute(
         "INSERT INTO users(name,email,password_hash,role,created_at) VALUES (?,?,?,?,?)",
         (
             payload.name.strip(),
             payload.email.lower(),
-            hash_password(payload.password),
+            password_hash,
             "user",
             now_iso(),
         ),
     )
-    conn.commit()
-    conn.close()
     return {"message": "Registration successful"}
 
 
-@app.post("/api/auth/login")
-def login(payload: LoginIn):
-    conn = db_conn()
+@app.post("/api/auth/register", status_code=status.HTTP_201_CREATED)
+async def register(payload: RegisterIn):
+    return await run_db(_register, payload)
+
+
+def _login(conn: sqlite3.Connection, payload: LoginIn) -> dict:
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE email = ?", (payload.email.lower(),))
     user = cur.fetchone()
     if not user or not verify_password(payload.password, user["password_hash"]):
-        conn.close()
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    check_deadline()
     token = issue_token()
     cur.execute(
         "INSERT INTO sessions(user_id,token,created_at) VALUES (?,?,?)",
         (user["id"], token, now_iso()),
     )
-    conn.commit()
-    conn.close()
     return {
         "token": token,
         "user": {
@@ -431,19 +573,25 @@ def login(payload: LoginIn):
     }
 
 
-@app.post("/api/auth/logout")
-def logout(user: sqlite3.Row = Depends(get_current_user), authorization: Optional[str] = Header(default=None)):
-    token = parse_bearer(authorization)
-    conn = db_conn()
+@app.post("/api/auth/login")
+async def login(payload: LoginIn):
+    return await run_db(_login, payload)
+
+
+def _logout(conn: sqlite3.Connection, token: str) -> dict:
     cur = conn.cursor()
     cur.execute("DELETE FROM sessions WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
     return {"message": "Logged out"}
 
 
+@app.post("/api/auth/logout")
+async def logout(user: sqlite3.Row = Depends(get_current_user), authorization: Optional[str] = Header(default=None)):
+    token = parse_bearer(authorization)
+    return await run_db(_logout, token)
+
+
 @app.get("/api/auth/me")
-def me(user: sqlite3.Row = Depends(get_current_user)):
+async def me(user: sqlite3.Row = Depends(get_current_user)):
     return {
         "id": user["id"],
         "name": user["name"],
@@ -473,17 +621,29 @@ def itinerary_row_to_dict(row: sqlite3.Row) -> dict:
     }
 
 
+def _list_itineraries(conn: sqlite3.Connection, where: str, params: list[object]) -> dict:
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT i.*, u.name AS creator_name, u.email AS creator_email
+        FROM itineraries i
+        JOIN users u ON u.id = i.created_by
+        {where}
+        ORDER BY i.updated_at DESC
+        """,
+        params,
+    )
+    return {"items": [itinerary_row_to_dict(r) for r in cur.fetchall()]}
+
+
 @app.get("/api/itineraries")
-def list_itineraries(
+async def list_itineraries(
     q: str = Query(default=""),
     region: str = Query(default=""),
     status_filter: str = Query(default="", alias="status"),
     mine: bool = Query(default=False),
     user: Optional[sqlite3.Row] = Depends(get_optional_user),
 ):
-    conn = db_conn()
-    cur = conn.cursor()
-
     clauses = []
     params: list[object] = []
 
@@ -498,7 +658,6 @@ def list_itineraries(
 
     if mine:
         if not user:
-            conn.close()
             raise HTTPException(status_code=401, detail="Login required for mine=true")
         clauses.append("i.created_by = ?")
         params.append(user["id"])
@@ -507,7 +666,6 @@ def list_itineraries(
 
     if status_filter:
         if not is_admin and status_filter.strip().lower() != "approved" and not mine:
-            conn.close()
             raise HTTPException(status_code=403, detail="Only admin can query non-approved status")
         clauses.append("i.status = ?")
         params.append(status_filter.strip().lower())
@@ -517,28 +675,11 @@ def list_itineraries(
 
     where = " WHERE " + " AND ".join(clauses) if clauses else ""
 
-    cur.execute(
-        f"""
-        SELECT i.*, u.name AS creator_name, u.email AS creator_email
-        FROM itineraries i
-        JOIN users u ON u.id = i.created_by
-        {where}
-        ORDER BY i.updated_at DESC
-        """,
-        params,
-    )
-    items = [itinerary_row_to_dict(r) for r in cur.fetchall()]
-    conn.close()
-    return {"items": items}
-
+    return await run_db(_list_itineraries, where, params)
 
-@app.post("/api/itineraries", status_code=status.HTTP_201_CREATED)
-def create_itinerary(payload: ItineraryIn, user: sqlite3.Row = Depends(get_current_user)):
-    if payload.budget_max < payload.budget_min:
-        raise HTTPException(status_code=400, detail="budget_max must be >= budget_min")
 
+def _create_itinerary(conn: sqlite3.Connection, payload: ItineraryIn, user: sqlite3.Row) -> dict:
     now = now_iso()
-    conn = db_conn()
     cur = conn.cursor()
     cur.execute(
         """
@@ -560,27 +701,25 @@ def create_itinerary(payload: ItineraryIn, user: sqlite3.Row = Depends(get_curre
             now,
         ),
     )
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return {"id": new_id, "message": "Itinerary submitted for review"}
+    return {"id": cur.lastrowid, "message": "Itinerary submitted for review"}
 
 
-@app.put("/api/itineraries/{itinerary_id}")
-def update_itinerary(itinerary_id: int, payload: ItineraryIn, user: sqlite3.Row = Depends(get_current_user)):
+@app.post("/api/itineraries", status_code=status.HTTP_201_CREATED)
+async def create_itinerary(payload: ItineraryIn, user: sqlite3.Row = Depends(get_current_user)):
     if payload.budget_max < payload.budget_min:
         raise HTTPException(status_code=400, detail="budget_max must be >= budget_min")
 
-    conn = db_conn()
+    return await run_db(_create_itinerary, payload, user)
+
+
+def _update_itinerary(conn: sqlite3.Connection, itinerary_id: int, payload: ItineraryIn, user: sqlite3.Row) -> dict:
     cur = conn.cursor()
     cur.execute("SELECT * FROM itineraries WHERE id = ?", (itinerary_id,))
     item = cur.fetchone()
     if not item:
-        conn.close()
         raise HTTPException(status_code=404, detail="Itinerary not found")
 
     if user["role"] != "admin" and item["created_by"] != user["id"]:
-        conn.close()
         raise HTTPException(status_code=403, detail="You can only edit your own itineraries")
 
     next_status = item["status"] if user["role"] == "admin" else "pending"
@@ -604,48 +743,53 @@ def update_itinerary(itinerary_id: int, payload: ItineraryIn, user: sqlite3.Row
             itinerary_id,
         ),
     )
-    conn.commit()
-    conn.close()
     return {"message": "Itinerary updated"}
 
 
-@app.delete("/api/itineraries/{itinerary_id}")
-def delete_itinerary(itinerary_id: int, user: sqlite3.Row = Depends(get_current_user)):
-    conn = db_conn()
+@app.put("/api/itineraries/{itinerary_id}")
+async def update_itinerary(itinerary_id: int, payload: ItineraryIn, user: sqlite3.Row = Depends(get_current_user)):
+    if payload.budget_max < payload.budget_min:
+        raise HTTPException(status_code=400, detail="budget_max must be >= budget_min")
+
+    return await run_db(_update_itinerary, itinerary_id, payload, user)
+
+
+def _delete_itinerary(conn: sqlite3.Connection, itinerary_id: int, user: sqlite3.Row) -> dict:
     cur = conn.cursor()
     cur.execute("SELECT * FROM itineraries WHERE id = ?", (itinerary_id,))
     item = cur.fetchone()
     if not item:
-        conn.close()
         raise HTTPException(status_code=404, detail="Itinerary not found")
 
     if user["role"] != "admin" and item["created_by"] != user["id"]:
-        conn.close()
         raise HTTPException(status_code=403, detail="You can only delete your own itineraries")
 
     cur.execute("DELETE FROM itineraries WHERE id = ?", (itinerary_id,))
-    conn.commit()
-    conn.close()
     return {"message": "Itinerary deleted"}
 
 
-@app.patch("/api/itineraries/{itinerary_id}/status")
-def set_status(itinerary_id: int, payload: StatusIn, admin: sqlite3.Row = Depends(require_admin)):
-    wanted = payload.status.strip().lower()
-    if wanted not in {"approved", "rejected", "pending"}:
-        raise HTTPException(status_code=400, detail="status must be approved, rejected, or pending")
+@app.delete("/api/itineraries/{itinerary_id}")
+async def delete_itinerary(itinerary_id: int, user: sqlite3.Row = Depends(get_current_user)):
+    return await run_db(_delete_itinerary, itinerary_id, user)
 
-    conn = db_conn()
+
+def _set_status(conn: sqlite3.Connection, itinerary_id: int, wanted: str) -> None:
     cur = conn.cursor()
     cur.execute("SELECT id FROM itineraries WHERE id = ?", (itinerary_id,))
     if not cur.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Itinerary not found")
 
     cur.execute(
         "UPDATE itineraries SET status = ?, updated_at = ? WHERE id = ?",
         (wanted, now_iso(), itinerary_id),
     )
-    conn.commit()
-    conn.close()
+
+
+@app.patch("/api/itineraries/{itinerary_id}/status")
+async def set_status(itinerary_id: int, payload: StatusIn, admin: sqlite3.Row = Depends(require_admin)):
+    wanted = payload.status.strip().lower()
+    if wanted not in {"approved", "rejected", "pending"}:
+        raise HTTPException(status_code=400, detail="status must be approved, rejected, or pending")
+
+    await run_db(_set_status, itinerary_id, wanted)
     return {"message": f"Itinerary marked as {wanted}", "by": admin["email"]}
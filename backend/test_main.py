@@ -0,0 +1,205 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+os.environ["TRIPTALES_DB_WORKERS"] = "1"
+os.environ["TRIPTALES_DB_QUEUE_LIMIT"] = "0"
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+
+ITINERARY = {
+    "title": "Test Trip",
+    "region": "Kashmir",
+    "duration_days": 2,
+    "budget_min": 1000,
+    "budget_max": 2000,
+    "image_url": "../images/dal-lake.jpg",
+    "details": "A short test itinerary.",
+}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", tmp_path / "test.db")
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture
+def admin_headers(client):
+    r = client.post("/api/auth/login", json={"email": "admin@triptales.local", "password": "admin123"})
+    return {"Authorization": f"Bearer {r.json()['token']}"}
+
+
+def itinerary_count() -> int:
+    conn = sqlite3.connect(main.DB_PATH)
+    count = conn.execute("SELECT COUNT(*) FROM itineraries").fetchone()[0]
+    conn.close()
+    return count
+
+
+def wait_for_idle_executor() -> None:
+    end = time.monotonic() + 5
+    while main._db_inflight and time.monotonic() < end:
+        time.sleep(0.01)
+    assert main._db_inflight == 0
+
+
+def slow_query(conn: sqlite3.Connection):
+    return conn.execute(
+        "WITH RECURSIVE r(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM r) SELECT COUNT(*) FROM r"
+    ).fetchone()
+
+
+def test_full_queue_returns_503_with_retry_after(client):
+    started, release = threading.Event(), threading.Event()
+
+    def blocker(conn):
+        started.set()
+        release.wait(5)
+
+    worker = threading.Thread(target=asyncio.run, args=(main.run_db(blocker),))
+    worker.start()
+    try:
+        assert started.wait(5)
+        r = client.get("/api/itineraries")
+        assert r.status_code == 503
+        assert r.headers["Retry-After"] == "1"
+    finally:
+        release.set()
+        worker.join()
+    wait_for_idle_executor()
+    assert client.get("/api/itineraries").status_code == 200
+
+
+def test_long_query_is_interrupted_at_deadline(client, monkeypatch):
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0.3)
+    start = time.monotonic()
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.run_db(slow_query))
+    assert exc.value.status_code == 503
+    assert time.monotonic() - start < 2
+    wait_for_idle_executor()
+
+
+def test_failed_job_releases_its_slot(client):
+    def broken(conn):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(main.run_db(broken))
+    wait_for_idle_executor()
+
+
+def test_lock_wait_past_deadline_commits_nothing(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0.5)
+    before = itinerary_count()
+    other = sqlite3.connect(main.DB_PATH, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        r = client.post("/api/itineraries", headers=admin_headers, json=ITINERARY)
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert r.status_code == 503
+    wait_for_idle_executor()
+    assert itinerary_count() == before
+
+
+def test_write_finishing_after_deadline_is_rolled_back(client, monkeypatch):
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0.2)
+
+    def slow_update(conn):
+        conn.execute("UPDATE itineraries SET title = 'changed'")
+        time.sleep(0.4)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.run_db(slow_update))
+    assert exc.value.status_code == 503
+    wait_for_idle_executor()
+    conn = sqlite3.connect(main.DB_PATH)
+    changed = conn.execute("SELECT COUNT(*) FROM itineraries WHERE title = 'changed'").fetchone()[0]
+    conn.close()
+    assert changed == 0
+
+
+def test_queued_job_dropped_at_deadline_releases_its_slot(client, monkeypatch):
+    monkeypatch.setattr(main, "DB_QUEUE_LIMIT", 1)
+    started, release = threading.Event(), threading.Event()
+    ran = []
+
+    def blocker(conn):
+        started.set()
+        release.wait(5)
+
+    worker = threading.Thread(target=asyncio.run, args=(main.run_db(blocker),))
+    worker.start()
+    try:
+        assert started.wait(5)
+        monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0.2)
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(main.run_db(lambda conn: ran.append(True)))
+        assert exc.value.status_code == 503
+    finally:
+        release.set()
+        worker.join()
+    wait_for_idle_executor()
+    assert ran == []
+
+
+def test_cancelled_request_commits_nothing_and_releases_its_slot(client):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_update(conn):
+        conn.execute("UPDATE itineraries SET title = 'changed'")
+        started.set()
+        release.wait(5)
+
+    async def cancel_midway():
+        task = asyncio.create_task(main.run_db(slow_update))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(cancel_midway())
+    finally:
+        release.set()
+    wait_for_idle_executor()
+    conn = sqlite3.connect(main.DB_PATH)
+    changed = conn.execute("SELECT COUNT(*) FROM itineraries WHERE title = 'changed'").fetchone()[0]
+    conn.close()
+    assert changed == 0
+
+
+def test_register_create_update_delete(client):
+    r = client.post(
+        "/api/auth/register",
+        json={"name": "Tester", "email": "tester@example.com", "password": "secret123"},
+    )
+    assert r.status_code == 201
+    r = client.post("/api/auth/login", json={"email": "tester@example.com", "password": "secret123"})
+    assert r.status_code == 200
+    headers = {"Authorization": f"Bearer {r.json()['token']}"}
+
+    r = client.post("/api/itineraries", headers=headers, json=ITINERARY)
+    assert r.status_code == 201
+    itinerary_id = r.json()["id"]
+
+    r = client.put(f"/api/itineraries/{itinerary_id}", headers=headers, json={**ITINERARY, "title": "Updated Trip"})
+    assert r.status_code == 200
+    items = client.get("/api/itineraries?mine=true", headers=headers).json()["items"]
+    assert [(i["id"], i["title"], i["status"]) for i in items] == [(itinerary_id, "Updated Trip", "pending")]
+
+    r = client.delete(f"/api/itineraries/{itinerary_id}", headers=headers)
+    assert r.status_code == 200
+    assert client.get("/api/itineraries?mine=true", headers=headers).json()["items"] == []
+    wait_for_idle_executor()